@@ -4,33 +4,36 @@ from __future__ import annotations
 
 import argparse
 import html
+import importlib.util
 import io
 import random
 import re
 import sys
-from typing import List, Tuple
+from typing import TYPE_CHECKING, List, Tuple
 
 import chess.pgn  # type: ignore
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import mm
-from reportlab.pdfgen import canvas
 
-try:
-    import requests  # type: ignore
-    from bs4 import BeautifulSoup  # type: ignore
-except ImportError:  # URL mode disabled
-    requests = None  # type: ignore
-    BeautifulSoup = None  # type: ignore
+# reportlab and the URL-mode libraries are imported where used, keeping
+# startup (e.g. --help) free of their import cost
+if TYPE_CHECKING:
+    from reportlab.pdfgen import canvas
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Constants & layout
 # ──────────────────────────────────────────────────────────────────────────────
 ROW_LEN, MAX_K, SENTINEL = 12, 6, 95
-PAGE_W, PAGE_H = A4
+mm = 72 / 2.54 * 0.1  # points per millimetre, as reportlab.lib.units.mm
+PAGE_W, PAGE_H = 210 * mm, 297 * mm  # reportlab.lib.pagesizes.A4
 MARG_L, MARG_R, MARG_T, MARG_B = 20 * mm, 15 * mm, 20 * mm, 15 * mm
 COL_GUTTER = 6 * mm
 LEGEND_PT, BOARD_PT = 7, 8
 BODY_MAX_PT, BODY_MIN_PT = 9, 6
+BODY_PT = BODY_MAX_PT  # no single-page fitting; always use the max size
+LINE_STEP = BODY_PT * 2  # body rows are double-spaced
+LEGEND_STEP = LEGEND_PT * 1.2
+LEGEND_BLOCK_H = LEGEND_STEP * 4 + BODY_PT  # 4 legend rows + gap
+BOARD_LINE_H = BOARD_PT * 1.2
+DIAGRAM_H = 8 * BOARD_LINE_H  # ASCII board, 8 ranks, no legends
 
 SAN_CHARS = (
     "KQRBN"  # pieces
@@ -39,6 +42,15 @@ SAN_CHARS = (
     "x" "+#" "=" "O-"  # symbols & castling dash
 )
 SAN_ALLOWED = {ord(c) for c in SAN_CHARS}
+# byte → cipher index (code - 32); 0xFF marks a char outside the alphabet
+SAN_TABLE = bytes(i - 32 if i in SAN_ALLOWED else 0xFF for i in range(256))
+# per-k translation tables: index → index + k, applied in one C-level pass
+SHIFT_TABLES = [bytes((i + k) & 0xFF for i in range(256)) for k in range(MAX_K + 1)]
+FILLER = tuple(range(SENTINEL))  # padding values 00–94, never the sentinel
+
+# shared RNG (seeded in main); bound methods skip per-call attribute lookups
+_rng = random.Random()
+_randrange = _rng.randrange
 
 # legend groups
 PIECES = "KQRBN"
@@ -46,18 +58,28 @@ FILES = "abcdefgh"
 RANKS = "12345678"
 SYMS = "x+#=O-"
 
-# Compile once
-URL_RE = re.compile(r"https?://")
-DASHES_RE = re.compile(r"^\.\.(\d+)$")
+EMPTY_DIAGRAM = b". . . . . . . .\n" * 8  # 16 bytes per rank, a8 first
+
+_TWO = tuple(f"{i:02}" for i in range(100))  # shared int → "NN" table, 00–99
+_LEGEND_LINES = [
+    f"{tag:<7}" + "  ".join(f"{ch}:{_TWO[ord(ch) - 32]}" for ch in chars)
+    for tag, chars in (("Pieces", PIECES), ("Files", FILES), ("Ranks", RANKS), ("Symbols", SYMS))
+]
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Helpers – PGN acquisition
 # ──────────────────────────────────────────────────────────────────────────────
 
 def _download_pgn_from_chessgames(url: str) -> str:
-    if requests is None or BeautifulSoup is None:
-        raise RuntimeError("requests & beautifulsoup4 required for URL mode")
-    soup = BeautifulSoup(requests.get(url, timeout=20).text, "html.parser")
+    try:
+        import requests  # type: ignore
+        from bs4 import BeautifulSoup  # type: ignore
+    except ImportError:  # URL mode disabled
+        raise RuntimeError("requests & beautifulsoup4 required for URL mode") from None
+    # lxml is a C parser that works on raw bytes; fall back when absent
+    parser = "lxml" if importlib.util.find_spec("lxml") is not None else "html.parser"
+    # hand the parser raw bytes; it sniffs the charset itself
+    soup = BeautifulSoup(requests.get(url, timeout=20).content, parser)
     ta = soup.find("textarea", id="olga-data")
     if ta and ta.text.strip():
         return ta.text.strip()
@@ -73,8 +95,35 @@ def _download_pgn_from_chessgames(url: str) -> str:
     raise ValueError("PGN not found on page")
 
 
-def load_game(src: str):
-    if URL_RE.match(src):
+class RawMoveVisitor(chess.pgn.BaseVisitor):
+    """Collect headers and mainline moves without building a GameNode tree."""
+
+    def begin_game(self):
+        self.headers = chess.pgn.Headers()
+        self.moves: List[chess.Move] = []
+
+    def begin_headers(self):
+        return self.headers
+
+    def visit_header(self, tagname: str, tagvalue: str):
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        return chess.pgn.SKIP  # mainline only
+
+    def visit_move(self, board: chess.Board, move: chess.Move):
+        self.moves.append(move)
+
+    def handle_error(self, error: Exception):
+        # like GameBuilder: log and keep the moves parsed so far
+        chess.pgn.LOGGER.error("%s while parsing %r", error, self.headers)
+
+    def result(self) -> RawMoveVisitor:
+        return self
+
+
+def load_game(src: str) -> RawMoveVisitor:
+    if src.startswith(("http://", "https://")):
         if "chessgames.com" not in src:
             raise ValueError("Only chessgames.com URLs supported in URL mode")
         stream = io.StringIO(_download_pgn_from_chessgames(src))
@@ -82,7 +131,7 @@ def load_game(src: str):
         stream = sys.stdin
     else:
         stream = open(src, "r", encoding="utf-8")
-    game = chess.pgn.read_game(stream)
+    game = chess.pgn.read_game(stream, Visitor=RawMoveVisitor)
     if game is None:
         raise ValueError("No game in PGN input")
     return game
@@ -93,10 +142,8 @@ def load_game(src: str):
 
 def ply_from_spec(spec: str) -> Tuple[int, str]:
     """Return ply index (1‑based) and side label ('.' / '..')."""
-    m = DASHES_RE.match(spec)
-    if m:
-        mv = int(m.group(1))
-        return mv * 2, ".."  # Black ply
+    if spec[:2] == ".." and spec[2:].isdigit():
+        return int(spec[2:]) * 2, ".."  # Black ply
     mv = int(spec)
     return mv * 2 - 1, "."  # White ply
 
@@ -104,168 +151,138 @@ def ply_from_spec(spec: str) -> Tuple[int, str]:
 # Encoding helpers
 # ──────────────────────────────────────────────────────────────────────────────
 
-def san_to_indices(san: str) -> List[int]:
-    indices = []
-    for ch in san:
-        code = ord(ch)
-        if code not in SAN_ALLOWED:
-            raise ValueError(f"Illegal SAN char '{ch}' in '{san}'")
-        indices.append(code - 32)
+def san_to_indices(san: str) -> bytes:
+    try:
+        indices = san.encode("ascii").translate(SAN_TABLE)
+    except UnicodeEncodeError as e:
+        raise ValueError(f"Illegal SAN char '{san[e.start]}' in '{san}'") from None
+    if 0xFF in indices:
+        raise ValueError(f"Illegal SAN char '{san[indices.index(0xFF)]}' in '{san}'")
     return indices
 
 
-def encode_move(san: str) -> Tuple[int, List[int]]:
+def encode_move(san: str) -> Tuple[int, bytes]:
     plain = san_to_indices(san)
     k_max = min(MAX_K, 94 - max(plain))
-    k = random.randint(1, k_max)
-    return k, [v + k for v in plain]
+    k = _randrange(1, k_max + 1)
+    return k, plain.translate(SHIFT_TABLES[k])
 
 
-def build_row(label: str, k: int, cipher: List[int]) -> str:
-    row = [k] + cipher + [SENTINEL]
-    while len(row) < ROW_LEN:
-        f = random.randint(0, 94)
-        if f != SENTINEL:
-            row.append(f)
-    return f"{label:<6}" + " ".join(f"{n:02}" for n in row)
+def build_row(label: str, k: int, cipher: bytes) -> str:
+    fillers = _rng.choices(FILLER, k=ROW_LEN - 2 - len(cipher))  # FILLER excludes SENTINEL
+    row = (k, *cipher, SENTINEL, *fillers)
+    return f"{label:<6}" + " ".join(map(_TWO.__getitem__, row))
 
 # ──────────────────────────────────────────────────────────────────────────────
 # PDF generation helpers
 # ──────────────────────────────────────────────────────────────────────────────
 
-def ascii_board(board: chess.Board) -> List[str]:
-    """Return 8×8 ASCII diagram without rank/file legends."""
-    rows = []
-    files = "abcdefgh"
-    for rank in range(8, 0, -1):
-        line = []
-        for file in files:
-            square = chess.square(ord(file) - 97, rank - 1)
-            piece = board.piece_at(square)
-            line.append(piece.symbol() if piece else ".")
-            line.append(" ")
-        rows.append("".join(line).rstrip())
-    return rows
+def ascii_board(board: chess.Board) -> str:
+    """Return 8×8 ASCII diagram (one line per rank) without rank/file legends."""
+    buf = bytearray(EMPTY_DIAGRAM)
+    for square, piece in board.piece_map().items():
+        buf[(7 - (square >> 3)) * 16 + (square & 7) * 2] = ord(piece.symbol())
+    return buf[:-1].decode("ascii")
 
 
 def draw_board(c: canvas.Canvas, board: chess.Board, x: float, y: float):
-    diagram = ascii_board(board)
-    c.setFont("Courier", BOARD_PT)
-    for ln in diagram:
-        c.drawString(x, y, ln)
-        y -= BOARD_PT * 1.2
-
-
-def diagram_height() -> float:
-    """Height of ASCII board diagram (8 ranks, no legends)."""
-    return 8 * BOARD_PT * 1.2
-    c.setFont("Courier", LEGEND_PT)
-    def line(tag: str, chars: str):
-        c.drawString(x, y, f"{tag:<7}" + "  ".join(f"{ch}:{ord(ch)-32:02}" for ch in chars))
-    line("Pieces", PIECES); y -= LEGEND_PT * 1.2
-    line("Files", FILES); y -= LEGEND_PT * 1.2
-    line("Ranks", RANKS); y -= LEGEND_PT * 1.2
-    line("Symbols", SYMS)
+    t = c.beginText(x, y)
+    t.setFont("Courier", BOARD_PT, leading=BOARD_LINE_H)
+    t.textLines(ascii_board(board))
+    c.drawText(t)
 
 
 def draw_legend(c: canvas.Canvas, x: float, y: float):
     """Render the 4‑row ASCII legend table."""
     c.setFont("Courier", LEGEND_PT)
-    for tag, chars in (("Pieces", PIECES), ("Files", FILES), ("Ranks", RANKS), ("Symbols", SYMS)):
-        c.drawString(x, y, f"{tag:<7}" + "  ".join(f"{ch}:{ord(ch)-32:02}" for ch in chars))
-        y -= LEGEND_PT * 1.2
-
-
-def best_body_pt():
-    return BODY_MAX_PT  # we no longer need to fit single page; keep max
+    for ln in _LEGEND_LINES:
+        c.drawString(x, y, ln)
+        y -= LEGEND_STEP
 
 
 def render_pdf(rows: List[str], board_before: chess.Board, outfile: str):
-    c = canvas.Canvas(outfile, pagesize=A4)
-    body_pt = best_body_pt()
-    line_h = body_pt
+    from reportlab.pdfgen import canvas
+
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=(PAGE_W, PAGE_H), pageCompression=1)
 
-    def new_page():
-        c.showPage()
-    
     # first page header
-    diagram_h = diagram_height()
     y = PAGE_H - MARG_T
     draw_board(c, board_before, MARG_L, y)
-    y -= diagram_h
+    y -= DIAGRAM_H
     draw_legend(c, MARG_L, y)
-    y -= LEGEND_PT * 4 * 1.2 + body_pt  # 4 legend rows
+    y -= LEGEND_BLOCK_H
     start_y_first = y
-    start_y_regular = PAGE_H - MARG_T - body_pt
-
-    col_x = [MARG_L, PAGE_W/2 + COL_GUTTER]
-    c.setFont("Courier", body_pt)
-
-    x, y = col_x[0], start_y_first
-    col_idx = 0
-
-    for row in rows:
-        if y < MARG_B:
-            # move to next column or page
-            if col_idx == 0:
-                col_idx = 1
-                x = col_x[1]
-                y = start_y_first if c.getPageNumber() == 1 else start_y_regular
-            else:
-                new_page()
-                c.setFont("Courier", body_pt)
-                x = col_x[0]
-                y = start_y_regular
-                col_idx = 0
-        c.drawString(x, y, row)
-        y -= line_h * 2
+    start_y_regular = PAGE_H - MARG_T - BODY_PT
+
+    col_x = (MARG_L, PAGE_W/2 + COL_GUTTER)
+
+    # split rows into per-column chunks up front: one text object per column
+    pos, first_page = 0, True
+    while pos < len(rows):
+        if not first_page:
+            c.showPage()
+        y0 = start_y_first if first_page else start_y_regular
+        per_col = int((y0 - MARG_B) // LINE_STEP) + 1  # rows at or above MARG_B
+        for x in col_x:
+            chunk = rows[pos : pos + per_col]
+            if chunk:
+                text = c.beginText(x, y0)
+                text.setFont("Courier", BODY_PT, leading=LINE_STEP)
+                text.textLines(chunk)
+                c.drawText(text)
+            pos += per_col
+        first_page = False
     c.save()
+    with open(outfile, "wb") as fh:
+        fh.write(buf.getvalue())
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Row collection
 # ──────────────────────────────────────────────────────────────────────────────
 
-def build_rows(game: chess.pgn.Game, start_ply: int, end_ply: int | None, shuffle_rows: bool) -> Tuple[List[str], chess.Board]:
+def build_rows(game: RawMoveVisitor, start_ply: int, end_ply: int | None, shuffle_rows: bool) -> Tuple[List[str], chess.Board]:
     """Collect encoded rows and board snapshot before start_ply."""
-    moves = list(game.mainline_moves())
+    moves = game.moves
     if start_ply < 1 or start_ply > len(moves):
         raise ValueError("start ply out of range")
 
-    # board before first included ply
-    board = game.board()
-    for m in moves[: start_ply - 1]:
-        board.push(m)
-    board_before = board.copy()
-
+    # single replay: snapshot the board just before the first included ply
+    board = game.headers.board()
     rows: List[str] = []
-    for ply_offset, move in enumerate(moves[start_ply - 1 :], start=start_ply):
-        if end_ply is not None and ply_offset > end_ply:
+    for ply, move in enumerate(moves, start=1):
+        if ply < start_ply:
+            board.push(move)
+            continue
+        if ply == start_ply:
+            board_before = board.copy(stack=False)  # history not needed downstream
+        if end_ply is not None and ply > end_ply:
             break
-        san = board.san(move)
-        label = f"{(ply_offset + 1)//2}{'..' if ply_offset % 2 == 0 else '.'}"
-        k, cipher = encode_move(san)
+        label = f"{(ply + 1)//2}{'..' if ply % 2 == 0 else '.'}"
+        k, cipher = encode_move(board.san_and_push(move))
         rows.append(build_row(label, k, cipher))
-        board.push(move)
 
-        if shuffle_rows:
-            random.shuffle(rows)
+    if shuffle_rows:
+        _rng.shuffle(rows)
     return rows, board_before
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Main CLI
 # ──────────────────────────────────────────────────────────────────────────────
 
+ARG_PARSER = argparse.ArgumentParser(description="Generate spoiler‑proof encoded move sheets")
+ARG_PARSER.add_argument("source")
+ARG_PARSER.add_argument("-o", "--output", default="study.pdf")
+ARG_PARSER.add_argument("--start", default="1", help="Start move (e.g. 15 or ..35)")
+ARG_PARSER.add_argument("--end", help="End move (e.g. 40 or ..45)")
+ARG_PARSER.add_argument("--seed", type=int)
+ARG_PARSER.add_argument("--ordered", action="store_true", help="output rows in game order (no shuffle)")
+
+
 def main():
-    ap = argparse.ArgumentParser(description="Generate spoiler‑proof encoded move sheets")
-    ap.add_argument("source")
-    ap.add_argument("-o", "--output", default="study.pdf")
-    ap.add_argument("--start", default="1", help="Start move (e.g. 15 or ..35)")
-    ap.add_argument("--end", help="End move (e.g. 40 or ..45)")
-    ap.add_argument("--seed", type=int)
-    ap.add_argument("--ordered", action="store_true", help="output rows in game order (no shuffle)")
-    args = ap.parse_args()
+    args = ARG_PARSER.parse_args()
 
-    random.seed(args.seed)
+    _rng.seed(args.seed)
 
     start_ply, _ = ply_from_spec(args.start)
     end_ply = None
@@ -278,7 +295,7 @@ def main():
         sys.exit(f"Error reading game: {e}")
 
     try:
-                rows, board_before = build_rows(game, start_ply, end_ply, shuffle_rows=not args.ordered)
+        rows, board_before = build_rows(game, start_ply, end_ply, shuffle_rows=not args.ordered)
     except Exception as e:
         sys.exit(f"Encoding error: {e}")
 